@@ -3,22 +3,31 @@ from dash import Dash, html, dcc, dash_table
 import dash
 import dash_bootstrap_components as dbc
 from dash.dependencies import State
+from dash.exceptions import PreventUpdate
 from dash_extensions.enrich import Output, DashProxy, Input, MultiplexerTransform
 from sqlalchemy import Table, create_engine
 from sqlalchemy.sql import select
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 import warnings
+import logging
 import os
 from flask_login import login_user, logout_user, current_user, LoginManager, UserMixin
 import configparser
 import plotly.express as px
 import pandas as pd
+import numpy as np
+from scipy import sparse
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import base64
 import io
+import threading
 
 warnings.filterwarnings("ignore")
+logger = logging.getLogger(__name__)
 
 ####################################
 # DATABASE Setup
@@ -86,167 +95,500 @@ class Users(UserMixin, Users):
 
 
 ######################
-# Figures
+# Upload Deduplication
 ######################
 
-figs = {} # container to hold all figures
-households_df = None
-transactions_df = None
-products_df = None
-transactions_combined_household_df = None
-all_three_combined_df = None
-
-def get_figures():
-    global figs
-    global households_df
-    global transactions_df
-    global products_df
-    global transactions_combined_household_df
-    global all_three_combined_df
+# natural key of each table; uploaded rows are matched against existing rows on these columns
+table_keys = {
+    'households_df': ['HSHD_NUM'],
+    'products_df': ['PRODUCT_NUM'],
+    'transactions_df': ['BASKET_NUM', 'PRODUCT_NUM', 'PURCHASE_'],
+}
+upload_conflict_mode = 'upsert' # uploaded rows whose key exists with different values: 'upsert' replaces the row, 'skip' keeps it
+
+# the given columns with values normalised by the table's dtype, because pandas picks dtypes
+# per file: a blank cell turns an int column of a CSV into float64. Numbers become float64,
+# dates datetime64, everything else text. Blank values, and values that cannot be read as the
+# column's type, become null
+def normalize_rows(df, columns, dtypes):
+    normalized = {}
+    for column in columns:
+        values = df[column] if column in df.columns else pd.Series(np.nan, index=df.index)
+        if pd.api.types.is_datetime64_any_dtype(dtypes[column]):
+            normalized[column] = pd.to_datetime(values, errors='coerce')
+        elif pd.api.types.is_numeric_dtype(dtypes[column]):
+            normalized[column] = pd.to_numeric(values, errors='coerce').astype('float64')
+        else:
+            if pd.api.types.is_float_dtype(values) and (values.dropna() % 1 == 0).all():
+                values = values.astype('Int64')
+            normalized[column] = values.astype(str).where(values.notna(), None)
+    return pd.DataFrame(normalized, index=df.index)
+
+# 64 bit hash of the given columns for each row, after normalising them
+def hash_rows(df, columns, dtypes):
+    return pd.util.hash_pandas_object(normalize_rows(df, columns, dtypes), index=False).to_numpy()
+
+# key hashes of every row in a table, kept sorted in a uint64 array with the row position and
+# a hash of the whole row in parallel arrays, so an upload is looked up with one vectorised
+# searchsorted instead of re-hashing the whole table. A table that lacks its natural key
+# columns, or where the key is not unique, is keyed on the row hash instead. Indexes are only
+# used by writers, under the dataset manager's write lock, and always describe the current
+# version's tables
+class DedupIndex:
+    def __init__(self, df, key_columns):
+        self.columns = list(df.columns)
+        self.dtypes = df.dtypes
+        self.key_columns = key_columns if all(column in df.columns for column in key_columns) else None
+
+        key_hashes, row_hashes = self.hash(df)
+        order = np.argsort(key_hashes, kind='stable')
+        keys = key_hashes[order]
+        if self.key_columns is not None and (keys[1:] == keys[:-1]).any():
+            logger.warning('key %s is not unique, deduplicating uploads on whole rows (no upserts)', self.key_columns)
+            self.key_columns = None
+            order = np.argsort(row_hashes, kind='stable')
+            keys = row_hashes[order]
+
+        self.keys = keys
+        self.positions = order.astype(np.int64)
+        self.row_hashes = row_hashes[order]
+
+    def hash(self, df):
+        row_hashes = hash_rows(df, self.columns, self.dtypes)
+        if self.key_columns is None:
+            return row_hashes, row_hashes
+        return hash_rows(df, self.key_columns, self.dtypes), row_hashes
+
+    # drop uploaded rows with a blank or unreadable key (they would all hash alike) and cast
+    # columns to the table's dtypes where that is lossless
+    def prepare(self, upload_df):
+        if self.key_columns is not None:
+            if not all(column in upload_df.columns for column in self.key_columns):
+                raise ValueError(f'upload is missing key columns {self.key_columns}')
+            blank_keys = normalize_rows(upload_df, self.key_columns, self.dtypes).isna().any(axis=1)
+            if blank_keys.any():
+                logger.warning('skipping %d uploaded rows with a blank or unreadable %s', blank_keys.sum(), self.key_columns)
+                upload_df = upload_df.loc[~blank_keys]
+
+        casts = {}
+        for column in upload_df.columns:
+            if column not in self.dtypes or upload_df[column].dtype == self.dtypes[column]:
+                continue
+            try:
+                cast = upload_df[column].astype(self.dtypes[column])
+                if cast.astype(upload_df[column].dtype).equals(upload_df[column]):
+                    casts[column] = cast
+            except (ValueError, TypeError):
+                pass
+        return upload_df.assign(**casts)
+
+    # split an upload into new rows and rows whose key exists with different values; identical
+    # rows are dropped and a key uploaded more than once keeps its last copy
+    def match(self, upload_df):
+        key_hashes, row_hashes = self.hash(upload_df)
+        last = ~pd.Series(key_hashes).duplicated(keep='last').to_numpy()
+        rows = np.flatnonzero(last)
+        key_hashes = key_hashes[last]
+        row_hashes = row_hashes[last]
+
+        slots = np.searchsorted(self.keys, key_hashes)
+        found = slots < len(self.keys)
+        found[found] = self.keys[slots[found]] == key_hashes[found]
+        changed = found.copy()
+        changed[found] = self.row_hashes[slots[found]] != row_hashes[found]
+
+        new_rows = pd.DataFrame({'row': rows[~found], 'key_hash': key_hashes[~found], 'row_hash': row_hashes[~found]})
+        changed_rows = pd.DataFrame({
+            'position': self.positions[slots[changed]],
+            'row': rows[changed],
+            'slot': slots[changed],
+            'row_hash': row_hashes[changed],
+        })
+        return new_rows, changed_rows
+
+    # record an applied upload; new rows were appended to the table starting at `start`
+    def commit(self, new_rows, changed_rows, start):
+        self.row_hashes[changed_rows['slot'].to_numpy()] = changed_rows['row_hash'].to_numpy()
+
+        new_keys = new_rows['key_hash'].to_numpy()
+        order = np.argsort(new_keys, kind='stable')
+        slots = np.searchsorted(self.keys, new_keys[order])
+        self.keys = np.insert(self.keys, slots, new_keys[order])
+        self.positions = np.insert(self.positions, slots, start + order)
+        self.row_hashes = np.insert(self.row_hashes, slots, new_rows['row_hash'].to_numpy()[order])
 
-    if all_three_combined_df is None:
 
-        # debug_engine = create_engine('sqlite:///db.sql', echo=False)
-        conn = engine
+######################
+# Datasets
+######################
 
-        # read data from database
-        households_df = pd.read_sql('SELECT * FROM households', conn)
-        transactions_df = pd.read_sql('SELECT * FROM transactions', conn)
-        products_df = pd.read_sql('SELECT * FROM products', conn)
+# one immutable version of the data. A snapshot is never modified once built: uploads build
+# the next version on the side and the dataset manager swaps it in
+class DatasetSnapshot:
+    def __init__(self, version, households_df, transactions_df, products_df, transactions_sample_df, strata_counts, dedup_indexes):
+        self.version = version
+        self.households_df = households_df
+        self.transactions_df = transactions_df
+        self.products_df = products_df
+        self.transactions_sample_df = transactions_sample_df
+        self.strata_counts = strata_counts
+        self.dedup_indexes = dedup_indexes # table name -> DedupIndex, built by the first upload to that table and carried forward
+        self.refs = 0 # reader pins, plus one held by the manager while this is the current version
 
         # combine data frames
         transactions_combined_household_df = transactions_df.merge(households_df, on='HSHD_NUM', how='left')
-        all_three_combined_df = transactions_combined_household_df.merge(products_df, on='PRODUCT_NUM', how='left')
+        self.all_three_combined_df = transactions_combined_household_df.merge(products_df, on='PRODUCT_NUM', how='left')
+        sample_combined_household_df = transactions_sample_df.merge(households_df, on='HSHD_NUM', how='left')
+        self.combined_sample_df = sample_combined_household_df.merge(products_df, on='PRODUCT_NUM', how='left')
+
+    # the next version, with some of the tables replaced
+    def replace(self, **tables):
+        current_tables = {
+            'households_df': self.households_df,
+            'transactions_df': self.transactions_df,
+            'products_df': self.products_df,
+            'transactions_sample_df': self.transactions_sample_df,
+            'strata_counts': self.strata_counts,
+        }
+        current_tables.update(tables)
+        return DatasetSnapshot(self.version + 1, dedup_indexes=self.dedup_indexes, **current_tables)
+
+# hands out the current snapshot to readers and publishes new ones from writers. Readers pin
+# a version and keep seeing it until they release it, however many uploads happen meanwhile;
+# once a replaced version has no pins left the reclaim callbacks drop everything cached for it
+class DatasetManager:
+    def __init__(self, load):
+        self.load = load # builds the first snapshot
+        self.current = None
+        self.lock = threading.Lock() # guards current and every snapshot's refs
+        self.write_lock = threading.Lock() # one writer builds the next version at a time
+        self.reclaim_callbacks = []
+
+    def on_reclaim(self, callback):
+        self.reclaim_callbacks.append(callback)
+        return callback
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                if self.current is not None:
+                    self.current.refs += 1
+                    return self.current
+            with self.write_lock:
+                if self.current is None:
+                    self.publish(self.load())
+
+    # take another reference to a snapshot the caller already holds
+    def retain(self, snapshot):
+        with self.lock:
+            snapshot.refs += 1
+        return snapshot
+
+    def release(self, snapshot):
+        with self.lock:
+            snapshot.refs -= 1
+            reclaimed = snapshot.refs == 0
+        if reclaimed:
+            for callback in self.reclaim_callbacks:
+                callback(snapshot.version)
+
+    @contextmanager
+    def pin(self):
+        snapshot = self.acquire()
+        try:
+            yield snapshot
+        finally:
+            self.release(snapshot)
+
+    # build the next version with build(current) while readers carry on with the current one.
+    # build may return current unchanged when there is nothing to publish
+    def update(self, build):
+        with self.write_lock:
+            if self.current is None:
+                self.publish(self.load())
+            snapshot = build(self.current)
+            if snapshot is not self.current:
+                self.publish(snapshot)
+
+    # caller holds write_lock
+    def publish(self, snapshot):
+        snapshot.refs = 1
+        with self.lock:
+            previous = self.current
+            self.current = snapshot
+        if previous is not None:
+            self.release(previous)
+
+# first version of the data, read from the database
+def load_snapshot():
+
+    # debug_engine = create_engine('sqlite:///db.sql', echo=False)
+    conn = engine
+
+    # read data from database
+    households_df = pd.read_sql('SELECT * FROM households', conn)
+    transactions_df = pd.read_sql('SELECT * FROM transactions', conn)
+    products_df = pd.read_sql('SELECT * FROM products', conn)
+
+    return build_snapshot(households_df, transactions_df, products_df)
+
+# first version of the given tables, with the transactions sample built for them
+def build_snapshot(households_df, transactions_df, products_df):
+    transactions_sample_df, strata_counts = build_transactions_sample(transactions_df)
+    return DatasetSnapshot(1, households_df, transactions_df, products_df, transactions_sample_df, strata_counts, {})
+
+datasets = DatasetManager(load_snapshot)
+
+
+######################
+# Figures
+######################
 
+figure_builders = {} # figure name -> function building it (and any figure sharing its data) from the combined data frame
+figure_cache = {} # (dataset version, figure name) -> figure
+
+def figure_builder(*names):
+    def register(build):
+        for name in names:
+            figure_builders[name] = build
+        return build
+    return register
+
+builder_locks = {} # (dataset version, builder) -> lock held while that builder runs
+builder_locks_lock = threading.Lock()
+
+@datasets.on_reclaim
+def evict_figures(version):
+    for key in list(figure_cache):
+        if key[0] == version:
+            figure_cache.pop(key, None)
+    with builder_locks_lock:
+        for key in list(builder_locks):
+            if key[0] == version:
+                del builder_locks[key]
+
+# build (or reuse) one figure for a pinned snapshot. Figures sharing a builder wait for
+# each other instead of running the same groupby twice
+def get_figure(name, snapshot):
+    figure = figure_cache.get((snapshot.version, name))
+    if figure is None:
+        build = figure_builders[name]
+        with builder_locks_lock:
+            lock = builder_locks.setdefault((snapshot.version, build), threading.Lock())
+        with lock:
+            figure = figure_cache.get((snapshot.version, name))
+            if figure is None:
+                built_figs = build(snapshot.all_three_combined_df)
+                for built_name, built_figure in built_figs.items():
+                    figure_cache[(snapshot.version, built_name)] = built_figure
+                figure = built_figs[name]
+    return figure
+
+@figure_builder('fig_units_by_year')
+def build_units_by_year(df):
+    figs = {}
 
     # units by year
     units_year_df = pd.DataFrame({
     'YEAR': ['2018', '2019', '2020', '2021'],
-    'UNITS': [all_three_combined_df.loc[all_three_combined_df['YEAR'] == 2018, 'UNITS'].sum(),
-                all_three_combined_df.loc[all_three_combined_df['YEAR'] == 2019, 'UNITS'].sum(),
-                all_three_combined_df.loc[all_three_combined_df['YEAR'] == 2020, 'UNITS'].sum(),
-                all_three_combined_df.loc[all_three_combined_df['YEAR'] == 2021, 'UNITS'].sum()]  
+    'UNITS': [df.loc[df['YEAR'] == 2018, 'UNITS'].sum(),
+                df.loc[df['YEAR'] == 2019, 'UNITS'].sum(),
+                df.loc[df['YEAR'] == 2020, 'UNITS'].sum(),
+                df.loc[df['YEAR'] == 2021, 'UNITS'].sum()]
     })
 
     figs['fig_units_by_year'] = px.bar(units_year_df, x="YEAR", y="UNITS", title='Units by Year')
+    return figs
+
+@figure_builder('fig_units_by_month')
+def build_units_by_month(df):
+    figs = {}
 
     # units by month
     units_month_df = pd.DataFrame({
     'PURCHASE_MONTH': [month for month in range(1, 13)],
     'UNITS': [
-                all_three_combined_df.loc[all_three_combined_df['PURCHASE_MONTH'] == month, 'UNITS'].sum() for month in range(1, 13)
-            ]  
+                df.loc[df['PURCHASE_MONTH'] == month, 'UNITS'].sum() for month in range(1, 13)
+            ]
     })
     figs['fig_units_by_month'] = px.line(units_month_df, x="PURCHASE_MONTH", y="UNITS", title="Units by Month", markers=True)
+    return figs
+
+@figure_builder('fig_units_by_week')
+def build_units_by_week(df):
+    figs = {}
 
     # units by week
     units_week_df = pd.DataFrame({
     'WEEK_NUM': [week for week in range(1, 53)],
     'UNITS': [
-                all_three_combined_df.loc[all_three_combined_df['WEEK_NUM'] == week, 'UNITS'].sum() for week in range(1, 53)
-            ]  
+                df.loc[df['WEEK_NUM'] == week, 'UNITS'].sum() for week in range(1, 53)
+            ]
     })
     figs['fig_units_by_week'] = px.line(units_week_df, x="WEEK_NUM", y="UNITS", title="Units by Week", markers=True)
+    return figs
 
+@figure_builder('fig_units_by_region')
+def build_units_by_region(df):
+    figs = {}
 
     # units by store region
     units_region_df = pd.DataFrame({
-    'STORE_REGION': list(all_three_combined_df['STORE_R'].unique()),
+    'STORE_REGION': list(df['STORE_R'].unique()),
     'UNITS': [
-                all_three_combined_df.loc[all_three_combined_df['STORE_R'] == store_region, 'UNITS'].sum() for store_region in list(all_three_combined_df['STORE_R'].unique())
-            ]  
+                df.loc[df['STORE_R'] == store_region, 'UNITS'].sum() for store_region in list(df['STORE_R'].unique())
+            ]
     })
     figs['fig_units_by_region'] = px.pie(units_region_df, values='UNITS', names='STORE_REGION', title='Units by Store Region')
+    return figs
+
+@figure_builder('fig_spend_by_year')
+def build_spend_by_year(df):
+    figs = {}
 
     # spend by year
     spend_year_df = pd.DataFrame({
     'YEAR': ['2018', '2019', '2020', '2021'],
-    'SPEND': [all_three_combined_df.loc[all_three_combined_df['YEAR'] == 2018, 'SPEND'].sum(),
-                all_three_combined_df.loc[all_three_combined_df['YEAR'] == 2019, 'SPEND'].sum(),
-                all_three_combined_df.loc[all_three_combined_df['YEAR'] == 2020, 'SPEND'].sum(),
-                all_three_combined_df.loc[all_three_combined_df['YEAR'] == 2021, 'SPEND'].sum()]  
+    'SPEND': [df.loc[df['YEAR'] == 2018, 'SPEND'].sum(),
+                df.loc[df['YEAR'] == 2019, 'SPEND'].sum(),
+                df.loc[df['YEAR'] == 2020, 'SPEND'].sum(),
+                df.loc[df['YEAR'] == 2021, 'SPEND'].sum()]
     })
     figs['fig_spend_by_year'] = px.bar(spend_year_df, x="YEAR", y="SPEND", title='Spend by Year')
+    return figs
+
+@figure_builder('fig_spend_by_month')
+def build_spend_by_month(df):
+    figs = {}
 
     # spend by month
     spend_month_df = pd.DataFrame({
     'PURCHASE_MONTH': [month for month in range(1, 13)],
     'SPEND': [
-                all_three_combined_df.loc[all_three_combined_df['PURCHASE_MONTH'] == month, 'SPEND'].sum() for month in range(1, 13)
-            ]  
+                df.loc[df['PURCHASE_MONTH'] == month, 'SPEND'].sum() for month in range(1, 13)
+            ]
     })
     figs['fig_spend_by_month'] = px.line(spend_month_df, x="PURCHASE_MONTH", y="SPEND", title="Spend by Month", markers=True)
+    return figs
+
+@figure_builder('fig_spend_by_week')
+def build_spend_by_week(df):
+    figs = {}
 
     # spend by week
     spend_week_df = pd.DataFrame({
     'WEEK_NUM': [week for week in range(1, 53)],
     'SPEND': [
-                all_three_combined_df.loc[all_three_combined_df['WEEK_NUM'] == week, 'SPEND'].sum() for week in range(1, 53)
-            ]  
+                df.loc[df['WEEK_NUM'] == week, 'SPEND'].sum() for week in range(1, 53)
+            ]
     })
     figs['fig_spend_by_week'] = px.line(spend_week_df, x="WEEK_NUM", y="SPEND", title="Spend by Week", markers=True)
+    return figs
+
+@figure_builder('fig_spend_by_region')
+def build_spend_by_region(df):
+    figs = {}
 
     # spend by region
     spend_region_df = pd.DataFrame({
-    'STORE_REGION': list(all_three_combined_df['STORE_R'].unique()),
+    'STORE_REGION': list(df['STORE_R'].unique()),
     'SPEND': [
-                all_three_combined_df.loc[all_three_combined_df['STORE_R'] == store_region, 'SPEND'].sum() for store_region in list(all_three_combined_df['STORE_R'].unique())
-            ]  
+                df.loc[df['STORE_R'] == store_region, 'SPEND'].sum() for store_region in list(df['STORE_R'].unique())
+            ]
     })
     figs['fig_spend_by_region'] = px.pie(spend_region_df, values='SPEND', names='STORE_REGION', title='Spend by Store Region')
+    return figs
 
+@figure_builder('fig_spend_by_marital')
+def build_spend_by_marital(df):
+    figs = {}
 
     # spend by martial status
     spend_marital_df = pd.DataFrame({
-    'MARITAL': list(all_three_combined_df['MARITAL'].unique()),
+    'MARITAL': list(df['MARITAL'].unique()),
     'SPEND': [
-                all_three_combined_df.loc[all_three_combined_df['MARITAL'] == marital_status, 'SPEND'].sum() for marital_status in list(all_three_combined_df['MARITAL'].unique())
-            ]  
+                df.loc[df['MARITAL'] == marital_status, 'SPEND'].sum() for marital_status in list(df['MARITAL'].unique())
+            ]
     })
     figs['fig_spend_by_marital'] = px.pie(spend_marital_df, values='SPEND', names='MARITAL', title='Spend by Martial Status')
+    return figs
+
+@figure_builder('fig_spend_by_children')
+def build_spend_by_children(df):
+    figs = {}
 
     # spend by number of children
     spend_children_df = pd.DataFrame({
-    'CHILDREN': [children for children in list(all_three_combined_df['CHILDREN'].unique())],
+    'CHILDREN': [children for children in list(df['CHILDREN'].unique())],
     'SPEND': [
-                all_three_combined_df.loc[all_three_combined_df['CHILDREN'] == children, 'SPEND'].sum() for children in list(all_three_combined_df['CHILDREN'].unique())
-            ]  
+                df.loc[df['CHILDREN'] == children, 'SPEND'].sum() for children in list(df['CHILDREN'].unique())
+            ]
     })
     figs['fig_spend_by_children'] = px.pie(spend_children_df, values='SPEND', names='CHILDREN', title='Spend by Number of Children')
+    return figs
+
+@figure_builder('fig_spend_by_hshdcomposition')
+def build_spend_by_hshdcomposition(df):
+    figs = {}
 
     # spend by household composition
     spend_hshdcomposition_df = pd.DataFrame({
-    'HSHD_COMPOSITION': [hshd_composition for hshd_composition in list(all_three_combined_df['HSHD_COMPOSITION'].unique())],
+    'HSHD_COMPOSITION': [hshd_composition for hshd_composition in list(df['HSHD_COMPOSITION'].unique())],
     'SPEND': [
-                all_three_combined_df.loc[all_three_combined_df['HSHD_COMPOSITION'] == hshd_composition, 'SPEND'].sum() for hshd_composition in list(all_three_combined_df['HSHD_COMPOSITION'].unique())
-            ]  
+                df.loc[df['HSHD_COMPOSITION'] == hshd_composition, 'SPEND'].sum() for hshd_composition in list(df['HSHD_COMPOSITION'].unique())
+            ]
     })
 
     figs['fig_spend_by_hshdcomposition'] = px.pie(spend_hshdcomposition_df, values='SPEND', names='HSHD_COMPOSITION', title='Spend by Household Composition')
+    return figs
 
+@figure_builder('fig_units_by_region_over_year', 'fig_spend_by_region_over_year')
+def build_region_over_year(df):
+    figs = {}
 
     # units by region over year
-    units_by_region_over_year_df = all_three_combined_df.groupby(['STORE_R', 'YEAR']).sum()
+    units_by_region_over_year_df = df.groupby(['STORE_R', 'YEAR']).sum()
     units_by_region_over_year_df.reset_index(inplace=True)
     figs['fig_units_by_region_over_year'] = px.sunburst(units_by_region_over_year_df, path=['YEAR', 'STORE_R'], values='UNITS', title="Units by Region")
 
     # spend by region over year
     figs['fig_spend_by_region_over_year'] = px.sunburst(units_by_region_over_year_df, path=['YEAR', 'STORE_R'], values='SPEND', title="Spend By Region")
+    return figs
+
+@figure_builder('fig_units_by_dept_over_year_df', 'fig_spend_by_dept_over_year_df')
+def build_dept_over_year(df):
+    figs = {}
 
-    # unit / spend department 
-    units_by_dept_over_year_df = all_three_combined_df.groupby(['DEPARTMENT', 'YEAR']).sum()
+    # unit / spend department
+    units_by_dept_over_year_df = df.groupby(['DEPARTMENT', 'YEAR']).sum()
     units_by_dept_over_year_df.reset_index(inplace=True)
-    units_by_dept_over_year_df['YEAR'] = units_by_dept_over_year_df['YEAR'].astype(str) 
+    units_by_dept_over_year_df['YEAR'] = units_by_dept_over_year_df['YEAR'].astype(str)
     figs['fig_units_by_dept_over_year_df'] = px.sunburst(units_by_dept_over_year_df, path=['YEAR', 'DEPARTMENT'], values='UNITS', title="Units By Department")
     figs['fig_spend_by_dept_over_year_df'] = px.sunburst(units_by_dept_over_year_df, path=['YEAR', 'DEPARTMENT'], values='SPEND', title="Spend By Department")
+    return figs
+
+@figure_builder('fig_units_by_incomerange_over_year_df', 'fig_spend_by_incomerange_over_year_df')
+def build_incomerange_over_year(df):
+    figs = {}
 
     # units / spend by incomerange over a year
-    units_by_incomerange_over_year_df = all_three_combined_df.groupby(['INCOME_RANGE', 'YEAR']).sum()
+    units_by_incomerange_over_year_df = df.groupby(['INCOME_RANGE', 'YEAR']).sum()
     units_by_incomerange_over_year_df.reset_index(inplace=True)
     units_by_incomerange_over_year_df['YEAR'] = units_by_incomerange_over_year_df['YEAR'].astype(str)
 
+    figs['fig_units_by_incomerange_over_year_df'] = px.bar(units_by_incomerange_over_year_df,
+        x="INCOME_RANGE", y="UNITS", color="YEAR", barmode="group", title="Units by Income Level")
+
+    figs['fig_spend_by_incomerange_over_year_df'] = px.bar(units_by_incomerange_over_year_df,
+        x="INCOME_RANGE", y="SPEND", color="YEAR", barmode="group", title="Spend by Income Level")
+    return figs
+
+@figure_builder('fig_units_by_agerange_over_year', 'fig_spend_by_agerange_over_year')
+def build_agerange_over_year(df):
+    figs = {}
+
     # units by agerange over a year
-    units_by_agerange_over_year_df = all_three_combined_df.groupby(['AGE_RANGE', 'YEAR']).sum()
+    units_by_agerange_over_year_df = df.groupby(['AGE_RANGE', 'YEAR']).sum()
     units_by_agerange_over_year_df.reset_index(inplace=True)
     units_by_agerange_over_year_df['YEAR'] = units_by_agerange_over_year_df['YEAR'].astype(str)
 
@@ -254,23 +596,353 @@ def get_figures():
             x="AGE_RANGE", y="UNITS", color="YEAR", barmode="group", title="Units by Age Range")
 
     # spend by agerange over a year
-    figs['fig_spend_by_agerange_over_year'] = px.bar(units_by_agerange_over_year_df, 
+    figs['fig_spend_by_agerange_over_year'] = px.bar(units_by_agerange_over_year_df,
         x="AGE_RANGE", y="SPEND", color="YEAR", barmode="group", title="Spend By Age Range")
+    return figs
 
-    # spend by agerange over a year
-    figs['fig_units_by_incomerange_over_year_df'] = px.bar(units_by_incomerange_over_year_df, 
-        x="INCOME_RANGE", y="UNITS", color="YEAR", barmode="group", title="Units by Income Level")
 
-    figs['fig_spend_by_incomerange_over_year_df'] = px.bar(units_by_incomerange_over_year_df, 
-        x="INCOME_RANGE", y="SPEND", color="YEAR", barmode="group", title="Spend by Income Level")
+######################
+# Approximate Aggregates
+######################
+
+sample_strata = ['YEAR', 'STORE_R']
+sample_fraction = 0.02 # share of each stratum kept in the sample
+sample_min_rows = 50 # small strata keep at least this many rows (or all of them)
+sample_confidence_z = 1.96 # 95% confidence intervals
+sample_rng = np.random.default_rng()
+
+# inclusion rate per stratum. It only ever shrinks as a stratum grows, which is what lets
+# an upload update the sample without revisiting the rows that were left out of it
+def stratum_sample_rates(counts):
+    return np.minimum(1.0, np.maximum(sample_fraction, sample_min_rows / counts)).rename('SAMPLE_RATE')
+
+# every row draws SAMPLE_KEY once and stays in the sample while the key is below its stratum's rate
+def filter_sample(sample, counts):
+    sample = sample.join(stratum_sample_rates(counts), on=sample_strata)
+    return sample.loc[sample['SAMPLE_KEY'] < sample['SAMPLE_RATE']].drop(columns='SAMPLE_RATE')
+
+# returns the sample and the rows per (YEAR, STORE_R) stratum in the full transactions table
+def build_transactions_sample(df):
+    counts = df.groupby(sample_strata, dropna=False).size()
+    return filter_sample(df.assign(SAMPLE_KEY=sample_rng.random(len(df))), counts), counts
+
+# fold an upload into the sample, touching only the changed rows and the sample. The sample is
+# indexed by row position in the transactions table; replaced rows are removed with their old
+# values and come back among the added rows with a fresh key
+def update_transactions_sample(sample, counts, added_rows, removed_rows):
+    counts = counts.add(added_rows.groupby(sample_strata, dropna=False).size(), fill_value=0)
+    counts = counts.sub(removed_rows.groupby(sample_strata, dropna=False).size(), fill_value=0).astype(int)
+    sample = sample.drop(index=removed_rows.index, errors='ignore')
+    sample = pd.concat([sample, added_rows.assign(SAMPLE_KEY=sample_rng.random(len(added_rows)))])
+    return filter_sample(sample, counts[counts > 0]), counts[counts > 0]
+
+# stratified estimate of the sum of `value` per group of the `by` columns, with the half width of its confidence interval
+def approximate_totals(sample, counts, by, value):
+    keys = sample_strata + [column for column in by if column not in sample_strata]
+    y = sample[value].astype(float)
+    totals = sample.assign(Y=y, Y2=y ** 2).groupby(keys, dropna=False)[['Y', 'Y2']].sum().reset_index()
+    totals = totals.join(sample.groupby(sample_strata, dropna=False).size().rename('n'), on=sample_strata)
+    totals = totals.join(counts.rename('N'), on=sample_strata)
+
+    # within a stratum the group total is N * mean(y * [row in group]); its variance comes from the
+    # sample variance of that indicator-weighted value, with the finite population correction
+    n, N = totals['n'], totals['N']
+    variance = (totals['Y2'] - totals['Y'] ** 2 / n) / (n - 1)
+    totals[value] = N * totals['Y'] / n
+    totals['VARIANCE'] = (N ** 2 * (1 - n / N) * variance / n).fillna(0)
+
+    totals = totals.groupby(by, dropna=False)[[value, 'VARIANCE']].sum().reset_index()
+    totals['ERROR'] = sample_confidence_z * np.sqrt(totals['VARIANCE'])
+    return totals.drop(columns='VARIANCE')
+
+# dashboard figures estimated from the sample (joined with households and products):
+# figure name -> (chart, value, grouping columns, title of the exact figure)
+estimated_figures = {
+    'fig_units_by_year': ('bar', 'UNITS', ['YEAR'], 'Units by Year'),
+    'fig_spend_by_year': ('bar', 'SPEND', ['YEAR'], 'Spend by Year'),
+    'fig_units_by_month': ('line', 'UNITS', ['PURCHASE_MONTH'], 'Units by Month'),
+    'fig_spend_by_month': ('line', 'SPEND', ['PURCHASE_MONTH'], 'Spend by Month'),
+    'fig_units_by_week': ('line', 'UNITS', ['WEEK_NUM'], 'Units by Week'),
+    'fig_spend_by_week': ('line', 'SPEND', ['WEEK_NUM'], 'Spend by Week'),
+    'fig_units_by_region_over_year': ('sunburst', 'UNITS', ['YEAR', 'STORE_R'], 'Units by Region'),
+    'fig_spend_by_region_over_year': ('sunburst', 'SPEND', ['YEAR', 'STORE_R'], 'Spend By Region'),
+    'fig_spend_by_marital': ('pie', 'SPEND', ['MARITAL'], 'Spend by Martial Status'),
+    'fig_spend_by_children': ('pie', 'SPEND', ['CHILDREN'], 'Spend by Number of Children'),
+    'fig_spend_by_hshdcomposition': ('pie', 'SPEND', ['HSHD_COMPOSITION'], 'Spend by Household Composition'),
+    'fig_units_by_dept_over_year_df': ('sunburst', 'UNITS', ['YEAR', 'DEPARTMENT'], 'Units By Department'),
+    'fig_spend_by_dept_over_year_df': ('sunburst', 'SPEND', ['YEAR', 'DEPARTMENT'], 'Spend By Department'),
+    'fig_units_by_agerange_over_year': ('grouped bar', 'UNITS', ['AGE_RANGE', 'YEAR'], 'Units by Age Range'),
+    'fig_spend_by_agerange_over_year': ('grouped bar', 'SPEND', ['AGE_RANGE', 'YEAR'], 'Spend By Age Range'),
+    'fig_units_by_incomerange_over_year_df': ('grouped bar', 'UNITS', ['INCOME_RANGE', 'YEAR'], 'Units by Income Level'),
+    'fig_spend_by_incomerange_over_year_df': ('grouped bar', 'SPEND', ['INCOME_RANGE', 'YEAR'], 'Spend by Income Level'),
+}
+
+# estimate of a dashboard figure, shown until the exact one is ready. Groups with a blank
+# key are dropped, as the exact figures' groupbys do
+def get_approximate_figure(name, snapshot):
+    chart, value, by, title = estimated_figures[name]
+    totals_df = approximate_totals(snapshot.combined_sample_df, snapshot.strata_counts, by, value).dropna(subset=by)
+    if 'YEAR' in by:
+        totals_df['YEAR'] = totals_df['YEAR'].astype(str)
+    title = f'{title} (estimate)'
+
+    if chart == 'bar':
+        return px.bar(totals_df, x=by[0], y=value, error_y='ERROR', title=title)
+    if chart == 'grouped bar':
+        return px.bar(totals_df, x=by[0], y=value, color='YEAR', barmode='group', error_y='ERROR', title=title)
+    if chart == 'line':
+        return px.line(totals_df, x=by[0], y=value, error_y='ERROR', title=title, markers=True)
+
+    # no error bars on pies and sunbursts; pies show the interval on hover
+    if chart == 'pie':
+        return px.pie(totals_df, values=value, names=by[0], hover_data=['ERROR'], title=title)
+    return px.sunburst(totals_df, path=by, values=value, title=title)
+
+figure_executor = ThreadPoolExecutor(max_workers=2)
+pending_figures = set() # (dataset version, figure builder) running in the background
+failed_figures = set() # (dataset version, figure builder) whose last background run raised
+pending_figures_lock = threading.Lock()
+
+def build_exact_figure(name, snapshot, key):
+    try:
+        get_figure(name, snapshot)
+    except Exception:
+        logger.exception('building %s for dataset version %d failed', name, snapshot.version)
+        with pending_figures_lock:
+            failed_figures.add(key)
+    finally:
+        with pending_figures_lock:
+            pending_figures.discard(key)
+        datasets.release(snapshot)
+
+# compute an exact figure in the background unless it is cached or its builder is already
+# running. The job keeps its own pin so the snapshot outlives the request that started it
+def start_exact_figure(name, snapshot):
+    key = (snapshot.version, figure_builders[name])
+    with pending_figures_lock:
+        if (snapshot.version, name) in figure_cache or key in pending_figures:
+            return
+        pending_figures.add(key)
+        failed_figures.discard(key)
+    figure_executor.submit(build_exact_figure, name, datasets.retain(snapshot), key)
+
+@datasets.on_reclaim
+def evict_failed_figures(version):
+    with pending_figures_lock:
+        failed_figures.difference_update([key for key in failed_figures if key[0] == version])
+
+
+######################
+# Market Basket Analysis
+######################
+
+basket_min_support = 0.01 # fraction of baskets an itemset must appear in
+basket_min_confidence = 0.2
+basket_max_len = 3 # largest itemset size to mine
+basket_processes = None # set to a worker count to mine FP-growth shards in a process pool
+basket_rules_cache = {} # dataset version -> rules data frame
+basket_rules_lock = threading.Lock() # held while mining, so concurrent requests share one run
+basket_rules_columns = ['ANTECEDENTS', 'CONSEQUENTS', 'SUPPORT', 'CONFIDENCE', 'LIFT']
+
+# build a sparse basket x commodity matrix (one row per BASKET_NUM, one column per COMMODITY)
+def build_basket_matrix(df):
+    baskets = df[['BASKET_NUM', 'COMMODITY']].dropna().drop_duplicates()
+    basket_codes, _ = pd.factorize(baskets['BASKET_NUM'])
+    commodity_codes, commodities = pd.factorize(baskets['COMMODITY'], sort=True)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(baskets), dtype=np.bool_), (basket_codes, commodity_codes)),
+        shape=(basket_codes.max() + 1 if len(baskets) else 0, len(commodities))
+    )
+    return matrix, list(commodities)
+
+class FPNode:
+    __slots__ = ('item', 'count', 'parent', 'children')
+
+    def __init__(self, item, parent):
+        self.item = item
+        self.count = 0
+        self.parent = parent
+        self.children = {}
+
+# transactions is a list of (items, count) pairs
+def build_fp_tree(transactions, min_count):
+    counts = Counter()
+    for items, count in transactions:
+        for item in items:
+            counts[item] += count
+    frequent = {item: count for item, count in counts.items() if count >= min_count}
+
+    root = FPNode(None, None)
+    header = {} # item -> every tree node holding that item
+    for items, count in transactions:
+        node = root
+        for item in sorted((i for i in items if i in frequent), key=lambda i: (-frequent[i], i)):
+            child = node.children.get(item)
+            if child is None:
+                child = FPNode(item, node)
+                node.children[item] = child
+                header.setdefault(item, []).append(child)
+            child.count += count
+            node = child
+    return frequent, header
+
+# yields (itemset, count) for every itemset in transactions with count >= min_count
+def fp_growth(transactions, min_count, max_len=None, suffix=()):
+    frequent, header = build_fp_tree(transactions, min_count)
+    for item, count in frequent.items():
+        itemset = (item,) + suffix
+        yield itemset, count
+        if max_len and len(itemset) >= max_len:
+            continue
+
+        # conditional pattern base: prefix paths leading to this item
+        conditional = []
+        for node in header[item]:
+            path = []
+            parent = node.parent
+            while parent.item is not None:
+                path.append(parent.item)
+                parent = parent.parent
+            if path:
+                conditional.append((path, node.count))
+        yield from fp_growth(conditional, min_count, max_len, itemset)
+
+# mine every itemset whose least frequent member is `item`. Runs in worker processes,
+# so it only takes the (small) slice of the basket matrix that the shard needs
+def mine_basket_shard(shard):
+    item, count, matrix, columns, min_count, max_len = shard
+    itemsets = [((item,), count)]
+    if max_len is None or max_len > 1:
+        transactions = [
+            ([columns[i] for i in matrix.indices[matrix.indptr[row]:matrix.indptr[row + 1]]], 1)
+            for row in range(matrix.shape[0])
+        ]
+        itemsets.extend(fp_growth(transactions, min_count, max_len, (item,)))
+    return itemsets
+
+def mine_frequent_itemsets(matrix, min_support, max_len=None, processes=None):
+    min_count = max(1, int(np.ceil(min_support * matrix.shape[0])))
+
+    if not processes or processes < 2:
+        transactions = [
+            (matrix.indices[matrix.indptr[row]:matrix.indptr[row + 1]].tolist(), 1)
+            for row in range(matrix.shape[0])
+        ]
+        return {frozenset(itemset): count for itemset, count in fp_growth(transactions, min_count, max_len)}
+
+    # partition by item: each shard holds the baskets containing one frequent item,
+    # restricted to the items ranked more frequent than it, so every itemset is mined exactly once
+    item_counts = np.asarray(matrix.sum(axis=0)).ravel()
+    order = [item for item in np.lexsort((np.arange(len(item_counts)), -item_counts)) if item_counts[item] >= min_count]
+    csc = matrix.tocsc()
+    shards = []
+    for rank, item in enumerate(order):
+        rows = csc.indices[csc.indptr[item]:csc.indptr[item + 1]]
+        columns = np.array(order[:rank], dtype=np.int64)
+        shards.append((int(item), int(item_counts[item]), matrix[rows][:, columns].tocsr(), columns.tolist(), min_count, max_len))
+
+    itemsets = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for shard_itemsets in executor.map(mine_basket_shard, shards, chunksize=max(1, len(shards) // (processes * 4))):
+            for itemset, count in shard_itemsets:
+                itemsets[frozenset(itemset)] = count
+    return itemsets
+
+def association_rules(itemsets, n_baskets, labels, min_confidence):
+    rules = []
+    for itemset, count in itemsets.items():
+        if len(itemset) < 2:
+            continue
+        items = sorted(itemset)
+        # every non-empty proper subset is an antecedent; all of them are frequent too
+        for mask in range(1, (1 << len(items)) - 1):
+            antecedent = frozenset(item for bit, item in enumerate(items) if mask & (1 << bit))
+            consequent = itemset - antecedent
+            confidence = count / itemsets[antecedent]
+            if confidence < min_confidence:
+                continue
+            rules.append({
+                'ANTECEDENTS': ', '.join(sorted(labels[i] for i in antecedent)),
+                'CONSEQUENTS': ', '.join(sorted(labels[i] for i in consequent)),
+                'SUPPORT': count / n_baskets,
+                'CONFIDENCE': confidence,
+                'LIFT': confidence / (itemsets[consequent] / n_baskets),
+            })
+
+    rules_df = pd.DataFrame(rules, columns=basket_rules_columns)
+    return rules_df.sort_values(['LIFT', 'CONFIDENCE'], ascending=False, ignore_index=True)
+
+# association rules for a pinned snapshot, mined once per dataset version
+def get_basket_rules(snapshot):
+    rules_df = basket_rules_cache.get(snapshot.version)
+    if rules_df is None:
+        with basket_rules_lock:
+            rules_df = basket_rules_cache.get(snapshot.version)
+            if rules_df is None:
+                matrix, commodities = build_basket_matrix(snapshot.all_three_combined_df)
+                itemsets = mine_frequent_itemsets(matrix, basket_min_support, basket_max_len, basket_processes)
+                rules_df = association_rules(itemsets, max(1, matrix.shape[0]), commodities, basket_min_confidence)
+                rules_df = rules_df.round({'SUPPORT': 4, 'CONFIDENCE': 4, 'LIFT': 3})
+                basket_rules_cache[snapshot.version] = rules_df
+    return rules_df
+
+@datasets.on_reclaim
+def evict_basket_rules(version):
+    basket_rules_cache.pop(version, None)
 
 
 ######################
 # Dashboard Layout
 ######################
 
+# dashboard panels: panel id -> figure names shown in it. Each panel is loaded on its own
+# the first time it is expanded, so only the figures somebody looks at get computed
+dashboard_panels = {
+    'panel-overview': [
+        'fig_units_by_year',
+        'fig_spend_by_year',
+        'fig_units_by_region_over_year',
+        'fig_spend_by_region_over_year',
+        'fig_units_by_month',
+        'fig_units_by_week',
+        'fig_spend_by_month',
+        'fig_spend_by_week',
+    ],
+    'panel-demographics': [
+        'fig_spend_by_marital',
+        'fig_spend_by_children',
+        'fig_spend_by_hshdcomposition',
+    ],
+    'panel-departments': [
+        'fig_units_by_dept_over_year_df',
+        'fig_spend_by_dept_over_year_df',
+    ],
+    'panel-age-income': [
+        'fig_units_by_agerange_over_year',
+        'fig_spend_by_agerange_over_year',
+        'fig_units_by_incomerange_over_year_df',
+        'fig_spend_by_incomerange_over_year_df',
+    ],
+}
+
+# empty graph plus a store recording what it currently shows ({'version': ..., 'exact': ...})
+def lazy_graph(name):
+    return html.Div([dcc.Graph(id=name), dcc.Store(id=f'{name}-shown')])
+
+# collapsible panel; only the first one starts expanded
+def dashboard_panel(panel_id, title, rows, expanded=False):
+    return dbc.Accordion([
+            dbc.AccordionItem(rows, title=title, item_id=panel_id)
+        ],
+        id=panel_id,
+        active_item=panel_id if expanded else None,
+        start_collapsed=not expanded,
+        style={'marginBottom': '10px'}
+    )
+
 def serve_layout():
-    get_figures()
+    with datasets.pin() as snapshot:
+        table_columns = sorted(snapshot.all_three_combined_df.columns)
     dashboard_layout = html.Div(children=[
 
         html.H1(children=['CS 5165/6065 Final']),
@@ -282,7 +954,7 @@ def serve_layout():
         dash_table.DataTable(
             id='table-sorting-filtering',
             columns=[
-                {'name': i, 'id': i, 'deletable': True} for i in sorted(all_three_combined_df.columns)
+                {'name': i, 'id': i, 'deletable': True} for i in table_columns
             ],
             page_current= 0,
             page_size= 15,
@@ -326,50 +998,70 @@ def serve_layout():
 
         html.P([html.B('Answers to project questions at bottom of page')], style={'padding': '10px'}),
 
-        dbc.Row([
-
-
-            dbc.Col(html.Div([dcc.Graph(figure=figs['fig_units_by_year'])]), width=3),
-            dbc.Col(html.Div([dcc.Graph(figure=figs['fig_spend_by_year'])]), width=3),
-            dbc.Col(html.Div([dcc.Graph(figure=figs['fig_units_by_region_over_year'])]), width=3),
-            dbc.Col(html.Div([dcc.Graph(figure=figs['fig_spend_by_region_over_year'])]), width=3)    
+        # swaps the sample estimates for the exact figures once they are computed
+        dcc.Interval(id='exact-figures-poll', interval=1000, disabled=True),
 
+        dashboard_panel('panel-overview', 'Units and Spend over Time', [
+            dbc.Row([
+                dbc.Col(lazy_graph('fig_units_by_year'), width=3),
+                dbc.Col(lazy_graph('fig_spend_by_year'), width=3),
+                dbc.Col(lazy_graph('fig_units_by_region_over_year'), width=3),
+                dbc.Col(lazy_graph('fig_spend_by_region_over_year'), width=3)
+            ]),
 
-        ]),
+            dbc.Row([
+                dbc.Col(lazy_graph('fig_units_by_month'), width=6),
+                dbc.Col(lazy_graph('fig_units_by_week'), width=6),
+            ]),
 
-        dbc.Row([
-            dbc.Col(html.Div([dcc.Graph(figure=figs['fig_units_by_month'])]), width=6),
-            dbc.Col(html.Div([dcc.Graph(figure=figs['fig_units_by_week'])]), width=6),
-        ]),
+            dbc.Row([
+                dbc.Col(lazy_graph('fig_spend_by_month'), width=6),
+                dbc.Col(lazy_graph('fig_spend_by_week'), width=6),
+            ]),
+        ], expanded=True),
 
-        dbc.Row([
-            dbc.Col(html.Div([dcc.Graph(figure=figs['fig_spend_by_month'])]), width=6),
-            dbc.Col(html.Div([dcc.Graph(figure=figs['fig_spend_by_week'])]), width=6),
+        dashboard_panel('panel-demographics', 'Spend by Household', [
+            dbc.Row([
+                dbc.Col(lazy_graph('fig_spend_by_marital'), width=4),
+                dbc.Col(lazy_graph('fig_spend_by_children'), width=4),
+                dbc.Col(lazy_graph('fig_spend_by_hshdcomposition'), width=4)
+            ]),
         ]),
 
-        dbc.Row([
-            dbc.Col(html.Div([dcc.Graph(figure=figs['fig_spend_by_marital'])]), width=4),
-            dbc.Col(html.Div([dcc.Graph(figure=figs['fig_spend_by_children'])]), width=4),
-            dbc.Col(html.Div([dcc.Graph(figure=figs['fig_spend_by_hshdcomposition'])]), width=4)
+        dashboard_panel('panel-departments', 'Units and Spend by Department', [
+            dbc.Row([
+                dbc.Col(lazy_graph('fig_units_by_dept_over_year_df'), width=6),
+                dbc.Col(lazy_graph('fig_spend_by_dept_over_year_df'), width=6)
+            ]),
         ]),
 
-        dbc.Row([
-            dbc.Col(html.Div([dcc.Graph(figure=figs['fig_units_by_dept_over_year_df'])]), width=6),
-            dbc.Col(html.Div([dcc.Graph(figure=figs['fig_spend_by_dept_over_year_df'])]), width=6)    
-        ]),
-        
-        
+        dashboard_panel('panel-age-income', 'Units and Spend by Age and Income', [
+            dbc.Row([
+                dbc.Col(lazy_graph('fig_units_by_agerange_over_year'), width=6),
+                dbc.Col(lazy_graph('fig_spend_by_agerange_over_year'), width=6),
+            ]),
 
-        dbc.Row([
-            dbc.Col(html.Div([dcc.Graph(figure=figs['fig_units_by_agerange_over_year'])]), width=6),
-            dbc.Col(html.Div([dcc.Graph(figure=figs['fig_spend_by_agerange_over_year'])]), width=6), 
+            dbc.Row([
+                dbc.Col(lazy_graph('fig_units_by_incomerange_over_year_df'), width=6),
+                dbc.Col(lazy_graph('fig_spend_by_incomerange_over_year_df'), width=6),
+            ]),
         ]),
 
-        
-
-        dbc.Row([
-            dbc.Col(html.Div([dcc.Graph(figure=figs['fig_units_by_incomerange_over_year_df'])]), width=6),
-            dbc.Col(html.Div([dcc.Graph(figure=figs['fig_spend_by_incomerange_over_year_df'])]), width=6), 
+        dashboard_panel('panel-basket', 'Market Basket Analysis', [
+            html.P(['Commodities that are frequently bought together in the same basket. Lift above 1 means the consequent is more likely to be bought when the antecedent is in the basket.']),
+            dash_table.DataTable(
+                id='basket-rules-table',
+                columns=[
+                    {'name': i, 'id': i} for i in basket_rules_columns
+                ],
+                page_size= 15,
+                sort_action='native',
+                filter_action='native',
+
+                style_table= {
+                    'overflow' : 'auto'
+                }
+            ),
         ]),
 
 
@@ -440,6 +1132,84 @@ def serve_layout():
     return dashboard_layout
 
 
+# one callback per graph: it fills the graph when its panel is expanded, showing the cached
+# figure when there is one and a sample estimate while an uncached KPI figure is computed.
+# Only graphs that can show an estimate listen to the poll
+def register_graph_callback(panel_id, name):
+    inputs = [Input(panel_id, 'active_item')]
+    if name in estimated_figures:
+        inputs.append(Input('exact-figures-poll', 'n_intervals'))
+
+    @app.callback(
+        Output(name, 'figure'),
+        Output(f'{name}-shown', 'data'),
+        Output('exact-figures-poll', 'disabled'),
+        inputs,
+        State(f'{name}-shown', 'data'))
+    def update_graph_figure(active_item, *args):
+        shown = args[-1]
+        if not active_item:
+            raise PreventUpdate
+
+        with datasets.pin() as snapshot:
+            version = snapshot.version
+            if shown is not None and shown['version'] == version and shown['exact']:
+                raise PreventUpdate
+
+            figure = figure_cache.get((version, name))
+            if figure is not None or name not in estimated_figures:
+                if figure is None:
+                    figure = get_figure(name, snapshot)
+                return figure, {'version': version, 'exact': True}, dash.no_update
+
+            # the estimate is already showing, keep waiting for the exact figure. If the panel
+            # was just expanded again the poll may have stopped while it was collapsed. When the
+            # exact figure failed, forgetting the estimate lets the poll stop; expanding the panel
+            # again retries it
+            if shown is not None and shown['version'] == version:
+                if dash.ctx.triggered_id == 'exact-figures-poll':
+                    if (version, figure_builders[name]) in failed_figures:
+                        return dash.no_update, None, dash.no_update
+                    raise PreventUpdate
+                start_exact_figure(name, snapshot)
+                return dash.no_update, dash.no_update, False
+
+            start_exact_figure(name, snapshot)
+            return get_approximate_figure(name, snapshot), {'version': version, 'exact': False}, False
+
+for panel_id, names in dashboard_panels.items():
+    for name in names:
+        register_graph_callback(panel_id, name)
+
+figure_panels = {name: panel_id for panel_id, names in dashboard_panels.items() for name in names}
+estimated_panels = [panel_id for panel_id, names in dashboard_panels.items() if any(name in estimated_figures for name in names)]
+
+# stop polling once no expanded panel is showing an estimate; expanding the panel again restarts it
+@app.callback(
+    Output('exact-figures-poll', 'disabled'),
+    Input('exact-figures-poll', 'n_intervals'),
+    [State(panel_id, 'active_item') for panel_id in estimated_panels]
+    + [State(f'{name}-shown', 'data') for name in estimated_figures],
+    prevent_initial_call=True)
+def stop_exact_figures_poll(n_intervals, *states):
+    expanded = dict(zip(estimated_panels, states[:len(estimated_panels)]))
+    shown = dict(zip(estimated_figures, states[len(estimated_panels):]))
+    return not any(
+        expanded[figure_panels[name]] and entry is not None and not entry['exact']
+        for name, entry in shown.items()
+    )
+
+# market basket rules are mined the first time their panel is expanded
+@app.callback(
+    Output('basket-rules-table', 'data'),
+    Input('panel-basket', 'active_item'))
+def update_basket_rules_table(active_item):
+    if not active_item:
+        raise PreventUpdate
+    with datasets.pin() as snapshot:
+        return get_basket_rules(snapshot).to_dict('records')
+
+
 # operators for dash table filtering
 operators = [['ge ', '>='],
              ['le ', '<='],
@@ -482,7 +1252,9 @@ def split_filter_part(filter_part):
     Input('table-sorting-filtering', 'filter_query'))
 def update_table(page_current, page_size, sort_by, filter):
     filtering_expressions = filter.split(' && ')
-    dff = all_three_combined_df
+    # snapshots are never modified, so the frame stays valid after the pin is released
+    with datasets.pin() as snapshot:
+        dff = snapshot.all_three_combined_df
     for filter_part in filtering_expressions:
         col_name, operator, filter_value = split_filter_part(filter_part)
         
@@ -575,7 +1347,6 @@ login =  html.Div([dcc.Location(id='url_login', refresh=True)
             , html.Div(children='', id='output-state')
         ] , style={'margin' : 'auto', 'width' : '50%', 'text-align' : 'center'}) #end div
 
-success = serve_layout()
 
 data = html.Div([dcc.Dropdown(
                     id='dropdown',
@@ -615,7 +1386,8 @@ def display_page(pathname):
         return login
     elif pathname == '/success':
         if current_user.is_authenticated:
-            return success
+            # built per visit, so the data is first read when somebody opens the dashboard
+            return serve_layout()
         else:
             return failed
     elif pathname =='/data':
@@ -710,12 +1482,39 @@ def logout_dashboard(n_clicks):
 # Upload data callback
 ###############
 
-def parse_contents(contents, filename, date):
-    global transactions_df
-    global households_df
-    global products_df
-    global all_three_combined_df
+# next dataset version with an uploaded table merged in through its dedup index
+def add_upload(current, table_name, upload_df):
+    table_df = getattr(current, table_name)
+    # only writers need an index, so it is built by the first upload to each table (under the write lock)
+    index = current.dedup_indexes.get(table_name)
+    if index is None:
+        index = current.dedup_indexes[table_name] = DedupIndex(table_df, table_keys[table_name])
+    upload_df = index.prepare(upload_df)
+    new_rows, changed_rows = index.match(upload_df)
+    if upload_conflict_mode == 'skip':
+        changed_rows = changed_rows.iloc[0:0]
+    if new_rows.empty and changed_rows.empty:
+        return current
+
+    # tables keep a RangeIndex, so row positions double as labels
+    upload_table_df = pd.concat([table_df, upload_df.iloc[new_rows['row'].to_numpy()]], axis=0, ignore_index=True)
+    positions = changed_rows['position'].tolist()
+    if positions:
+        updates = upload_df.iloc[changed_rows['row'].to_numpy()]
+        for column in updates.columns:
+            upload_table_df.loc[positions, column] = updates[column].to_numpy()
+
+    tables = {table_name: upload_table_df}
+    if table_name == 'transactions_df':
+        added_rows = upload_table_df.loc[positions + list(range(len(table_df), len(upload_table_df)))]
+        tables['transactions_sample_df'], tables['strata_counts'] = update_transactions_sample(
+            current.transactions_sample_df, current.strata_counts, added_rows, table_df.loc[positions])
+
+    snapshot = current.replace(**tables)
+    index.commit(new_rows, changed_rows, len(table_df))
+    return snapshot
 
+def parse_contents(contents, filename, date):
     content_type, content_string = contents.split(',')
 
 
@@ -723,25 +1522,23 @@ def parse_contents(contents, filename, date):
 
     decoded = base64.b64decode(content_string)
     try:
+        # the tables hold literal 'null' strings, so only empty cells are read as blank
         if 'csv' in filename:
             # Assume that the user uploaded a CSV file
             upload_df = pd.read_csv(
-                io.StringIO(decoded.decode('utf-8')))
+                io.StringIO(decoded.decode('utf-8')), keep_default_na=False, na_values=[''])
         elif 'xls' in filename:
             # Assume that the user uploaded an excel file
-            upload_df = pd.read_excel(io.BytesIO(decoded))
+            upload_df = pd.read_excel(io.BytesIO(decoded), keep_default_na=False, na_values=[''])
     
         if 'transaction' in filename:
-            transactions_df = pd.concat([transactions_df, upload_df], axis=0).drop_duplicates()
-            all_three_combined_df = None
+            datasets.update(lambda current: add_upload(current, 'transactions_df', upload_df))
             return serve_layout()
         elif 'household' in filename:
-            households_df = pd.concat([households_df, upload_df], axis=0).drop_duplicates()
-            all_three_combined_df = None
+            datasets.update(lambda current: add_upload(current, 'households_df', upload_df))
             return serve_layout()
         elif 'product' in filename:
-            products_df = pd.concat([products_df, upload_df], axis=0).drop_duplicates()
-            all_three_combined_df = None
+            datasets.update(lambda current: add_upload(current, 'products_df', upload_df))
             return serve_layout()
         else:
             return serve_layout()
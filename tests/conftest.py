@@ -0,0 +1,66 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+# synthetic households, transactions and products tables shaped like the database's
+def make_tables(n_transactions=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    households_df = pd.DataFrame({
+        'HSHD_NUM': np.arange(1, 501),
+        'MARITAL': rng.choice(['Married', 'Single', 'null'], 500),
+        'CHILDREN': rng.choice(['1', '2', 'null'], 500),
+        'HSHD_COMPOSITION': rng.choice(['1 Adult', '2 Adults', '2 Adults and Kids'], 500),
+        'AGE_RANGE': rng.choice(['19-24', '25-34', '35-44', '45-54'], 500),
+        'INCOME_RANGE': rng.choice(['<35K', '35-49K', '50-74K', '75-99K'], 500),
+    })
+    products_df = pd.DataFrame({
+        'PRODUCT_NUM': np.arange(1, 201),
+        'DEPARTMENT': rng.choice(['FOOD', 'NON-FOOD', 'PHARMA'], 200),
+        'COMMODITY': rng.choice([f'COMMODITY {i}' for i in range(15)], 200),
+    })
+    transactions_df = pd.DataFrame({
+        'BASKET_NUM': rng.integers(1, n_transactions // 4, n_transactions),
+        'HSHD_NUM': rng.integers(1, 501, n_transactions),
+        'PURCHASE_': '2020-01-01',
+        'PRODUCT_NUM': rng.integers(1, 201, n_transactions),
+        'SPEND': rng.gamma(2, 3, n_transactions).round(2),
+        'UNITS': rng.integers(1, 5, n_transactions),
+        'STORE_R': rng.choice(['EAST', 'WEST', 'SOUTH', 'CENTRAL'], n_transactions),
+        'WEEK_NUM': rng.integers(1, 53, n_transactions),
+        'YEAR': rng.choice([2018, 2019, 2020, 2021], n_transactions),
+        'PURCHASE_MONTH': rng.integers(1, 13, n_transactions),
+    })
+    transactions_df = transactions_df.drop_duplicates(app.table_keys['transactions_df']).reset_index(drop=True)
+    return households_df, transactions_df, products_df
+
+
+@pytest.fixture(scope='session')
+def tables():
+    return make_tables()
+
+
+# app.datasets serving the synthetic tables instead of the database, with every cache emptied
+@pytest.fixture
+def datasets(tables):
+    def reset():
+        app.datasets.current = None
+        app.figure_cache.clear()
+        app.builder_locks.clear()
+        app.basket_rules_cache.clear()
+
+    load = app.datasets.load
+    reset()
+    app.datasets.load = lambda: app.build_snapshot(*(table.copy() for table in tables))
+    yield app.datasets
+    app.figure_executor.shutdown(wait=True)
+    app.figure_executor = app.ThreadPoolExecutor(max_workers=2)
+    app.datasets.load = load
+    reset()
@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+
+def exact_totals(df, by, value):
+    return df.groupby(by)[value].sum()
+
+
+def estimated_totals(sample, counts, by, value):
+    return app.approximate_totals(sample, counts, by, value).set_index(by)
+
+
+def combined(households_df, transactions_df, products_df):
+    return transactions_df.merge(households_df, on='HSHD_NUM', how='left').merge(products_df, on='PRODUCT_NUM', how='left')
+
+
+# share of grouped sums whose 95% interval holds the exact value, over many independent samples
+def test_confidence_intervals_cover_exact_totals(tables, monkeypatch):
+    households_df, transactions_df, products_df = tables
+    monkeypatch.setattr(app, 'sample_rng', np.random.default_rng(1))
+    population = combined(households_df, transactions_df, products_df)
+    groupings = [(['YEAR'], 'SPEND'), (['PURCHASE_MONTH'], 'UNITS'), (['YEAR', 'DEPARTMENT'], 'SPEND'), (['MARITAL'], 'SPEND')]
+
+    covered = []
+    for _ in range(200):
+        sample, counts = app.build_transactions_sample(transactions_df)
+        sample = combined(households_df, sample, products_df)
+        for by, value in groupings:
+            exact = exact_totals(population, by, value)
+            estimate = estimated_totals(sample, counts, by, value).reindex(exact.index)
+            covered.append(((estimate[value] - exact).abs() <= estimate['ERROR']).to_numpy())
+
+    coverage = np.concatenate(covered).mean()
+    assert 0.92 <= coverage <= 0.98
+
+
+def test_fully_sampled_strata_are_exact(tables, monkeypatch):
+    households_df, transactions_df, products_df = tables
+    monkeypatch.setattr(app, 'sample_fraction', 1.0)
+    sample, counts = app.build_transactions_sample(transactions_df)
+    assert len(sample) == len(transactions_df)
+
+    sample = combined(households_df, sample, products_df)
+    population = combined(households_df, transactions_df, products_df)
+    for by in (['YEAR'], ['WEEK_NUM'], ['YEAR', 'STORE_R'], ['AGE_RANGE', 'YEAR']):
+        estimate = estimated_totals(sample, counts, by, 'SPEND')
+        assert (estimate['ERROR'] == 0).all()
+        pd.testing.assert_series_equal(estimate['SPEND'], exact_totals(population, by, 'SPEND'), check_names=False)
+
+
+def assert_sample_consistent(snapshot):
+    table = snapshot.transactions_df
+    sample = snapshot.transactions_sample_df
+    counts = snapshot.strata_counts
+
+    expected_counts = table.groupby(app.sample_strata, dropna=False).size()
+    pd.testing.assert_series_equal(counts.sort_index(), expected_counts.sort_index(), check_names=False, check_dtype=False)
+
+    # sampled rows are indexed by table position and hold that row's current values
+    assert sample.index.is_unique
+    assert sample.index.isin(table.index).all()
+    pd.testing.assert_frame_equal(sample[table.columns], table.loc[sample.index], check_dtype=False)
+
+    rates = app.stratum_sample_rates(counts)
+    assert (sample['SAMPLE_KEY'].to_numpy() < rates.reindex(pd.MultiIndex.from_frame(sample[app.sample_strata])).to_numpy()).all()
+
+
+@pytest.mark.parametrize('fraction', [app.sample_fraction, 1.0])
+def test_uploads_keep_sample_consistent(datasets, monkeypatch, fraction):
+    monkeypatch.setattr(app, 'sample_rng', np.random.default_rng(2))
+    monkeypatch.setattr(app, 'sample_fraction', fraction)
+    rng = np.random.default_rng(3)
+
+    for round in range(5):
+        with datasets.pin() as snapshot:
+            table = snapshot.transactions_df
+
+        # new rows, some of them in a stratum that does not exist yet
+        appended = table.sample(300, random_state=round).copy()
+        appended['BASKET_NUM'] = 10 ** 6 * (round + 1) + np.arange(300)
+        appended.loc[appended.index[:20], 'YEAR'] = 2022
+
+        # existing rows with new values, some of them moving to another stratum
+        upserted = table.sample(200, random_state=100 + round).copy()
+        upserted['SPEND'] = rng.gamma(2, 3, 200).round(2)
+        upserted.loc[upserted.index[:50], 'STORE_R'] = 'NORTH'
+
+        upload_df = pd.concat([appended, upserted], ignore_index=True)
+        datasets.update(lambda current: app.add_upload(current, 'transactions_df', upload_df))
+
+        with datasets.pin() as snapshot:
+            assert len(snapshot.transactions_df) == len(table) + 300
+            assert_sample_consistent(snapshot)
+            if fraction == 1.0:
+                assert len(snapshot.transactions_sample_df) == len(snapshot.transactions_df)
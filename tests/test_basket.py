@@ -0,0 +1,65 @@
+from collections import Counter
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+import app
+
+
+def random_basket_matrix(n_baskets=400, n_items=12, seed=0):
+    rng = np.random.default_rng(seed)
+    return sparse.csr_matrix(rng.random((n_baskets, n_items)) < rng.uniform(0.05, 0.5, n_items))
+
+
+# every itemset of up to max_len items counted directly from the baskets
+def brute_force_itemsets(matrix, min_support, max_len):
+    min_count = max(1, int(np.ceil(min_support * matrix.shape[0])))
+    counts = Counter()
+    for row in range(matrix.shape[0]):
+        items = sorted(matrix.indices[matrix.indptr[row]:matrix.indptr[row + 1]].tolist())
+        for size in range(1, min(max_len or len(items), len(items)) + 1):
+            for itemset in combinations(items, size):
+                counts[frozenset(itemset)] += 1
+    return {itemset: count for itemset, count in counts.items() if count >= min_count}
+
+
+@pytest.mark.parametrize('processes', [None, 2])
+@pytest.mark.parametrize('max_len', [None, 2, 3])
+def test_frequent_itemsets_match_brute_force(max_len, processes):
+    matrix = random_basket_matrix()
+    itemsets = app.mine_frequent_itemsets(matrix, 0.03, max_len, processes)
+    assert itemsets == brute_force_itemsets(matrix, 0.03, max_len)
+
+
+def test_association_rules_measures():
+    baskets_df = pd.DataFrame({
+        'BASKET_NUM': [1, 1, 2, 2, 2, 3, 3, 4],
+        'COMMODITY': ['BREAD', 'MILK', 'BREAD', 'MILK', 'EGGS', 'BREAD', 'EGGS', 'MILK'],
+    })
+    matrix, commodities = app.build_basket_matrix(baskets_df)
+    assert commodities == ['BREAD', 'EGGS', 'MILK']
+
+    itemsets = app.mine_frequent_itemsets(matrix, 0.5)
+    rules_df = app.association_rules(itemsets, matrix.shape[0], commodities, 0.0)
+
+    # BREAD 3, MILK 3, EGGS 2, BREAD+MILK 2, BREAD+EGGS 2 of 4 baskets; MILK+EGGS (1) is not frequent
+    expected_df = pd.DataFrame([
+        ['BREAD', 'EGGS', 0.5, 2 / 3, 4 / 3],
+        ['BREAD', 'MILK', 0.5, 2 / 3, 8 / 9],
+        ['EGGS', 'BREAD', 0.5, 1.0, 4 / 3],
+        ['MILK', 'BREAD', 0.5, 2 / 3, 8 / 9],
+    ], columns=app.basket_rules_columns)
+    rules_df = rules_df.sort_values(['ANTECEDENTS', 'CONSEQUENTS'], ignore_index=True)
+    pd.testing.assert_frame_equal(rules_df, expected_df)
+
+
+def test_no_baskets_give_no_rules():
+    matrix, commodities = app.build_basket_matrix(pd.DataFrame({'BASKET_NUM': [], 'COMMODITY': []}))
+    itemsets = app.mine_frequent_itemsets(matrix, app.basket_min_support, app.basket_max_len)
+    rules_df = app.association_rules(itemsets, max(1, matrix.shape[0]), commodities, app.basket_min_confidence)
+    assert itemsets == {}
+    assert rules_df.empty
+    assert list(rules_df.columns) == app.basket_rules_columns
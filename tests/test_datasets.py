@@ -0,0 +1,59 @@
+import threading
+
+import numpy as np
+
+import app
+
+
+# readers page, filter and chart pinned versions while one writer keeps publishing uploads
+def test_readers_see_whole_versions_while_uploads_publish(datasets, tables):
+    transactions_df = tables[1]
+    n_readers, n_uploads, upload_rows = 4, 20, 200
+    done = threading.Event()
+    errors = []
+    versions = [[] for _ in range(n_readers)]
+
+    def read(reader):
+        rng = np.random.default_rng(reader)
+        try:
+            while not done.is_set():
+                with datasets.pin() as snapshot:
+                    for df in (snapshot.all_three_combined_df, snapshot.transactions_df, snapshot.transactions_sample_df):
+                        assert df is not None
+                    assert len(snapshot.all_three_combined_df) == len(snapshot.transactions_df)
+                    versions[reader].append(snapshot.version)
+                    if rng.random() < 0.2:
+                        app.get_figure('fig_spend_by_year', snapshot)
+                    if rng.random() < 0.02:
+                        app.get_basket_rules(snapshot)
+
+                page = app.update_table(int(rng.integers(0, 5)), 15, [{'column_id': 'SPEND', 'direction': 'desc'}], '{YEAR} = 2020 && {SPEND} > 5')
+                assert len(page) == 15
+        except Exception as e:
+            errors.append(e)
+
+    readers = [threading.Thread(target=read, args=(reader,)) for reader in range(n_readers)]
+    for reader in readers:
+        reader.start()
+    try:
+        for upload in range(n_uploads):
+            upload_df = transactions_df.sample(upload_rows, random_state=upload).copy()
+            upload_df['BASKET_NUM'] = 10 ** 6 * (upload + 1) + np.arange(upload_rows)
+            datasets.update(lambda current: app.add_upload(current, 'transactions_df', upload_df))
+    finally:
+        done.set()
+        for reader in readers:
+            reader.join()
+
+    assert not errors
+    for seen in versions:
+        assert seen
+        assert all(earlier <= later for earlier, later in zip(seen, seen[1:]))
+
+    current = datasets.current
+    assert current.version == 1 + n_uploads
+    assert current.refs == 1
+    assert len(current.transactions_df) == len(transactions_df) + n_uploads * upload_rows
+    assert {version for version, _ in app.figure_cache} <= {current.version}
+    assert {version for version, _ in app.builder_locks} <= {current.version}
+    assert set(app.basket_rules_cache) <= {current.version}
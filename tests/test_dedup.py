@@ -0,0 +1,111 @@
+import base64
+
+import numpy as np
+import pandas as pd
+
+import app
+
+
+# upload a data frame the way the dashboard does, as a CSV file
+def upload_csv(df, filename):
+    contents = 'data:text/csv;base64,' + base64.b64encode(df.to_csv(index=False).encode()).decode()
+    return app.parse_contents(contents, filename, 0)
+
+
+def test_reuploading_a_table_publishes_nothing(datasets):
+    with datasets.pin() as snapshot:
+        pass
+
+    upload_csv(snapshot.transactions_df, 'transactions.csv')
+    upload_csv(snapshot.households_df, 'households.csv')
+    upload_csv(snapshot.products_df, 'products.csv')
+    assert datasets.current is snapshot
+    assert snapshot.version == 1
+
+
+# a blank cell makes pandas read the whole column as float64, which must not change how the other rows compare
+def test_blank_numeric_cell_does_not_make_rows_new(datasets):
+    with datasets.pin() as snapshot:
+        table = snapshot.transactions_df
+
+    new_row = table.head(1).assign(BASKET_NUM=10 ** 6, UNITS=np.nan)
+    upload_df = pd.concat([table.head(50), new_row], ignore_index=True)
+    upload_csv(upload_df, 'transactions.csv')
+
+    current = datasets.current
+    assert current.version == 2
+    assert len(current.transactions_df) == len(table) + 1
+    pd.testing.assert_frame_equal(current.transactions_df.head(len(table)), table, check_dtype=False)
+    assert np.isnan(current.transactions_df['UNITS'].iloc[-1])
+
+
+def test_conflict_mode(datasets, monkeypatch):
+    with datasets.pin() as snapshot:
+        table = snapshot.households_df
+    upload_df = table.head(3).assign(MARITAL='Widowed')
+
+    monkeypatch.setattr(app, 'upload_conflict_mode', 'skip')
+    upload_csv(upload_df, 'households.csv')
+    assert datasets.current is snapshot
+
+    monkeypatch.setattr(app, 'upload_conflict_mode', 'upsert')
+    upload_csv(upload_df, 'households.csv')
+    households_df = datasets.current.households_df
+    assert len(households_df) == len(table)
+    assert (households_df['MARITAL'].head(3) == 'Widowed').all()
+    pd.testing.assert_frame_equal(households_df.iloc[3:], table.iloc[3:])
+    combined_df = datasets.current.all_three_combined_df
+    assert (combined_df.loc[combined_df['HSHD_NUM'].isin(upload_df['HSHD_NUM']), 'MARITAL'] == 'Widowed').all()
+
+
+# blank keys, and keys that cannot be read as numbers, would all hash alike
+def test_rows_with_blank_keys_are_dropped(datasets):
+    with datasets.pin() as snapshot:
+        households_df = snapshot.households_df
+        transactions_df = snapshot.transactions_df
+
+    upload_df = households_df.head(3).astype({'HSHD_NUM': object})
+    upload_df['HSHD_NUM'] = [None, 'abc', 'xyz']
+    upload_csv(upload_df, 'households.csv')
+    assert datasets.current is snapshot
+
+    upload_df = pd.concat([transactions_df.head(20), transactions_df.head(1).assign(PRODUCT_NUM=np.nan)], ignore_index=True)
+    upload_csv(upload_df, 'transactions.csv')
+    assert datasets.current is snapshot
+
+
+def test_duplicate_keys_in_an_upload_keep_the_last_copy(datasets):
+    with datasets.pin() as snapshot:
+        table = snapshot.households_df
+
+    upload_df = pd.concat([
+        table.head(1).assign(MARITAL='Married'),
+        table.head(1).assign(HSHD_NUM=9001, MARITAL='Married'),
+        table.head(1).assign(MARITAL='Widowed'),
+        table.head(1).assign(HSHD_NUM=9001, MARITAL='Single'),
+    ], ignore_index=True)
+    upload_csv(upload_df, 'households.csv')
+
+    households_df = datasets.current.households_df.set_index('HSHD_NUM')
+    assert len(households_df) == len(table) + 1
+    assert households_df.loc[table['HSHD_NUM'].iloc[0], 'MARITAL'] == 'Widowed'
+    assert households_df.loc[9001, 'MARITAL'] == 'Single'
+
+
+# without a unique key there is nothing to upsert: only exact copies of existing rows are dropped
+def test_non_unique_key_falls_back_to_row_hashes(datasets, tables, monkeypatch, caplog):
+    households_df, transactions_df, products_df = tables
+    transactions_df = pd.concat([transactions_df, transactions_df.head(1).assign(SPEND=-1.0)], ignore_index=True)
+    monkeypatch.setattr(datasets, 'load', lambda: app.build_snapshot(households_df, transactions_df.copy(), products_df))
+    with datasets.pin() as snapshot:
+        pass
+
+    upload_csv(transactions_df.tail(10), 'transactions.csv')
+    assert datasets.current is snapshot
+    assert 'not unique' in caplog.text
+
+    changed_df = transactions_df.head(1).assign(SPEND=1000.0)
+    upload_csv(changed_df, 'transactions.csv')
+    current = datasets.current
+    assert len(current.transactions_df) == len(transactions_df) + 1
+    pd.testing.assert_frame_equal(current.transactions_df.head(len(transactions_df)), transactions_df)